@@ -6,17 +6,49 @@ MIT
 """
 
 import math
-from typing import List, Dict, Set
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from itertools import combinations
+from operator import itemgetter
+from typing import List, Dict, FrozenSet, Optional, Tuple
+
+LN_2 = math.log(2)
 
 Item = str
-Basket = Set[Item]  # In this example, we don't consider quantity / item / basket, but just the presence / absence of
-                    # an item in a given basket. Considering quantities may be relevant in some applications,
-                    # but likely not in most.
+Basket = FrozenSet[Item]  # In this example, we don't consider quantity / item / basket, but just the presence /
+                          # absence of an item in a given basket. Considering quantities may be relevant in some
+                          # applications, but likely not in most.
 ITEMS: List[Item] = ['Car', 'Tennis Ball', 'Tennis Racket', 'Laundry Detergent', 'Softener', 'Flour', 'Milk',
                      'Screwdriver',
                      'Toothpaste']
 
 
+def item_bitmaps(baskets: List[Basket]) -> Dict[Item, int]:
+    """
+    Index the baskets by item: for each item, an int whose bit k is set iff baskets[k] contains the item.
+
+    Counting the baskets that contain both i and j then boils down to popcount(bitmaps[i] & bitmaps[j]), which is
+    a handful of machine instructions per 64 baskets instead of two set lookups per basket.
+
+    :param baskets: all the baskets considered
+    :return: Dict[Item, int]
+    """
+    # Python ints are immutable, so OR-ing bits one at a time into them would copy the whole bitmap on every basket
+    # (quadratic in the number of baskets). Set the bits in mutable byte buffers instead, and convert once at the end.
+    size = (len(baskets) + 7) // 8
+    rows: Dict[Item, bytearray] = {}
+    for k, b in enumerate(baskets):
+        byte, bit = k >> 3, 1 << (k & 7)
+        for item in b:
+            row = rows.get(item)
+            if row is None:
+                row = rows[item] = bytearray(size)
+            row[byte] |= bit
+    return {item: int.from_bytes(row, 'little') for item, row in rows.items()}
+
+
+@dataclass(slots=True, init=False, eq=False)
 class ContingencyTable:
     """
     Compute and store a contingency table, that is, counts of co-occurrence between i and j
@@ -28,22 +60,43 @@ class ContingencyTable:
       i    |  O_11  | O_12  |    R_1
      ¬i    |  O_21  | O_22  |    R_2
            |    C1  |   C2  |      N
-    """
-
 
-    def __init__(self, i: Item, j: Item, baskets: List[Basket]):
+    Tables are built for every pair of items, so they are slotted dataclasses: no per-instance __dict__, and no
+    reference to the baskets they were counted from. Like any plain object, they compare and hash by identity.
+    """
+    i: Item
+    j: Item
+    O_11: int
+    O_12: int
+    O_21: int
+    O_22: int
+    C_1: int
+    C_2: int
+    R_1: int
+    R_2: int
+    N: int
+    E_11: float
+    E_12: float
+    E_21: float
+    E_22: float
+    _nats: Optional[float] = field(repr=False)
+
+    def __init__(self, i: Item, j: Item, O_11: int, freq_i: int, freq_j: int, N: int):
+        """
+        All four cells follow from how many times i and j appear together, how many times each appears at all,
+        and the number of baskets. See `from_baskets` and `contingency_tables` to get those counts.
+        """
         self.i = i
         self.j = j
-        self.baskets = baskets
 
         # how many times i and j appear in the same basket
-        self.O_11 = sum([1 for b in baskets if i in b and j in b])
+        self.O_11 = O_11
         # How many times i appears without j
-        self.O_12 = sum([1 for b in baskets if i in b and j not in b])
+        self.O_12 = freq_i - O_11
         # How many times j appears without i
-        self.O_21 = sum([1 for b in baskets if i not in b and j in b])
+        self.O_21 = freq_j - O_11
         # How many baskets without i or j
-        self.O_22 = sum([1 for b in baskets if i not in b and j not in b])
+        self.O_22 = N - freq_i - freq_j + O_11
 
         # Marginal values:
         self.C_1 = self.O_11 + self.O_21
@@ -61,8 +114,44 @@ class ContingencyTable:
         self.E_12 = self.R_1 * self.C_2 / self.N
         self.E_22 = self.R_2 * self.C_2 / self.N
 
+        # \sum_{i, j} O_ij log \frac{O_ij}{E_ij}, computed on first use (see `_information`)
+        self._nats = None
+
+    @classmethod
+    def from_baskets(cls, i: Item, j: Item, baskets: List[Basket],
+                     bitmaps: Optional[Dict[Item, int]] = None) -> 'ContingencyTable':
+        """
+        Count i and j in the baskets and build their table. With the basket bitmaps, each count is a popcount.
+        Pass precomputed bitmaps when building many tables on the same baskets (or better, use `contingency_tables`).
+        Without them, only i and j are counted, in a single pass over the baskets: indexing the whole catalogue to
+        score one pair would cost far more than it saves.
+        """
+        if bitmaps is not None:
+            present_i = bitmaps.get(i, 0)
+            present_j = bitmaps.get(j, 0)
+            return cls(i, j, (present_i & present_j).bit_count(), present_i.bit_count(), present_j.bit_count(),
+                       len(baskets))
+
+        O_11 = freq_i = freq_j = 0
+        for b in baskets:
+            has_i = i in b
+            has_j = j in b
+            O_11 += has_i & has_j
+            freq_i += has_i
+            freq_j += has_j
+        return cls(i, j, O_11, freq_i, freq_j, len(baskets))
+
+    def local_mutual_information(self):
+        r"""
+        log_2 \frac{O_11}{E_11}, see `local_mutual_information`.
+
+        The expectation is that of the contingency table, where N is the number of baskets: the probability of finding
+        i in a basket is R_1 / N, and independent items are found together in R_1 * C_1 / N baskets.
+        """
+        return math.log2(self.O_11 / self.E_11) if self.O_11 > 0 else 0
+
     def mutual_information(self):
-        """From the definition,
+        r"""From the definition,
 
         MI(i, j) = \sum_{i, j} O_ij log_2 \frac{O_ij}{E_ij}
 
@@ -71,17 +160,10 @@ class ContingencyTable:
         uniformly assembled, for each cells in the contingency table. It's a generalization of the
         local_mutual_information using much more of the available information.
         """
-        # We calculate each element of the sum separately, to avoid passing a 0 value to the log.
-        x11 = self.O_11 * math.log2(self.O_11 / self.E_11) if self.O_11 > 0 else 0
-        x12 = self.O_12 * math.log2(self.O_12 / self.E_12) if self.O_12 > 0 else 0
-        x21 = self.O_21 * math.log2(self.O_21 / self.E_21) if self.O_21 > 0 else 0
-        x22 = self.O_22 * math.log2(self.O_22 / self.E_22) if self.O_22 > 0 else 0
-        # print(x11, x12, x21, x22)
-        return x11 + x12 + x21 + x22
-
+        return self._information() / LN_2
 
     def log_likelihood(self):
-        """
+        r"""
         Eerily similar to the mutual information, this is also a fantastic approximation of
         Fisher's Exact Test, which, as the name implies, is exact, but also computationally intractable.
 
@@ -89,13 +171,26 @@ class ContingencyTable:
 
         ll(i, j) = 2 * \sum_{i, j} O_ij log \frac{O_ij}{E_ij}
         """
-        # We calculate each element of the sum separately, to avoid passing a 0 value to the log.
-        x11 = self.O_11 * math.log(self.O_11 / self.E_11) if self.O_11 > 0 else 0
-        x12 = self.O_12 * math.log(self.O_12 / self.E_12) if self.O_12 > 0 else 0
-        x21 = self.O_21 * math.log(self.O_21 / self.E_21) if self.O_21 > 0 else 0
-        x22 = self.O_22 * math.log(self.O_22 / self.E_22) if self.O_22 > 0 else 0
-
-        return 2 * (x11 + x12 + x21 + x22)
+        return 2 * self._information()
+
+    def _information(self) -> float:
+        r"""\sum_{i, j} O_ij log \frac{O_ij}{E_ij}, the sum shared by the mutual information and the log-likelihood."""
+        # For items that are close to independent, each O_ab / E_ab is close to 1 and the four terms nearly cancel out,
+        # so they are computed as O_ab log1p((O_ab N - R_a C_b) / (R_a C_b)): the numerator is exact on ints, and no
+        # precision is lost before the log. The sum is a Kullback-Leibler divergence and can't be negative, the clamp
+        # only guards against rounding.
+        # Empty cells are skipped, to avoid passing a 0 value to the log (their term is 0 anyway).
+        # The result is kept, as both metrics are usually computed on the same table.
+        if self._nats is None:
+            N = self.N
+            nats = 0.0
+            for O, R, C in ((self.O_11, self.R_1, self.C_1), (self.O_12, self.R_1, self.C_2),
+                            (self.O_21, self.R_2, self.C_1), (self.O_22, self.R_2, self.C_2)):
+                if O > 0:
+                    RC = R * C
+                    nats += O * math.log1p((O * N - RC) / RC)
+            self._nats = max(0.0, nats)
+        return self._nats
 
     def __str__(self) -> str:
         """Pretty-ish print of the main contingency table"""
@@ -112,7 +207,68 @@ class ContingencyTable:
 """
 
 
-def local_mutual_information(i: Item, j: Item, baskets: List[Basket]) -> float:
+def contingency_tables(items: List[Item], baskets: List[Basket], bitmaps: Optional[Dict[Item, int]] = None,
+                       workers: Optional[int] = 1) -> Dict[Tuple[Item, Item], ContingencyTable]:
+    """
+    Build the contingency tables of all pairs of items at once.
+
+    The baskets are indexed a single time, and the frequency of each item (the marginals R_1 / C_1 of every table it
+    is part of) is counted once, instead of once per pair. What is left for each pair is the co-occurrence count, a
+    single AND + popcount on the basket bitmaps.
+
+    The pairs are all independent, so on large catalogues the work can be spread over several processes: each one
+    receives the bitmaps once, then builds the tables of whole rows (an item and all the items after it).
+
+    :param items: Items to pair
+    :param baskets: all the baskets considered
+    :param bitmaps: basket bitmaps of the items, if already known (see `item_bitmaps`)
+    :param workers: number of processes to use. 1 (the default) builds everything in the current process, None uses
+        all the available CPUs.
+    :return: Dict[Tuple[Item, Item], ContingencyTable], for all i < j (all the metrics are symmetrical)
+    """
+    if bitmaps is None:
+        bitmaps = item_bitmaps(baskets)
+    N = len(baskets)
+    # Sorting the items once means every pair from combinations() is already in i < j order, so we only ever visit
+    # the upper triangle instead of comparing the names of all M^2 pairs and throwing half of them away.
+    rows = []
+    for item in sorted(set(items)):
+        present = bitmaps.get(item, 0)
+        rows.append((item, present, present.bit_count()))
+
+    if workers == 1:
+        return {(i, j): ContingencyTable(i, j, (present_i & present_j).bit_count(), freq_i, freq_j, N)
+                for (i, present_i, freq_i), (j, present_j, freq_j) in combinations(rows, 2)}
+
+    workers = workers or os.cpu_count() or 1
+    # A few chunks per process, so that the long first rows and the short last ones even out.
+    chunksize = max(1, len(rows) // (4 * workers))
+    with ProcessPoolExecutor(workers, initializer=_init_rows, initargs=(rows, N)) as executor:
+        return {(table.i, table.j): table
+                for tables in executor.map(_row_tables, range(len(rows)), chunksize=chunksize)
+                for table in tables}
+
+
+# Per-process state of the parallel `contingency_tables`, set once by the pool initializer.
+_rows: List[Tuple[Item, int, int]] = []
+_N = 0
+
+
+def _init_rows(rows: List[Tuple[Item, int, int]], N: int):
+    global _rows, _N
+    _rows = rows
+    _N = N
+
+
+def _row_tables(a: int) -> List[ContingencyTable]:
+    """Tables of the pairs (i, j) where i is the a-th item, for all the items j after it."""
+    i, present_i, freq_i = _rows[a]
+    return [ContingencyTable(i, j, (present_i & present_j).bit_count(), freq_i, freq_j, _N)
+            for j, present_j, freq_j in _rows[a + 1:]]
+
+
+def local_mutual_information(i: Item, j: Item, baskets: List[Basket],
+                             bitmaps: Optional[Dict[Item, int]] = None) -> float:
     """
     "Simple" Mutual information. Look at the ratio of co-occurrence observed vs. co-occurrence expected under the
     null hypothesis that items are randomly (and uniformly) distributed among baskets.
@@ -125,23 +281,17 @@ def local_mutual_information(i: Item, j: Item, baskets: List[Basket]) -> float:
     This measure does not take into account the size of the measured samples, and will return the same results for
     O = 2 and E = 1, than for O = 2*10^25 and E = 10^25. It will therefore kind of break for rarely purchased items.
 
+    It only needs O_11 and E_11 of the contingency table of i and j: when the table is already there, use
+    `ContingencyTable.local_mutual_information` rather than counting again. Otherwise, i and j are counted in a single
+    pass over the baskets (or with a popcount, given the bitmaps).
+
     :param i: Item
     :param j: Item
     :param baskets: all the baskets considered
+    :param bitmaps: basket bitmaps of the items, if already known (see `item_bitmaps`)
     :return: float
     """
-    # Observed co-occurrences:
-    O = sum([1 for b in baskets if i in b and j in b ])
-    if O == 0:
-        return 0
-    freq_i = sum([1 for b in baskets if i in b])
-    freq_j = sum([1 for b in baskets if j in b])
-    N = sum([len(b) for b in baskets])
-
-    E = freq_i * freq_j / N
-
-    return math.log2(O / E)
-
+    return ContingencyTable.from_baskets(i, j, baskets, bitmaps).local_mutual_information()
 
 
 if __name__ == '__main__':
@@ -181,31 +331,39 @@ if __name__ == '__main__':
                {'Toothpaste', 'Milk'},
                {'Toothpaste', 'Milk'},
                {'Toothpaste', 'Milk'}]
-
-    # Check that we didn't misspell any items
-    assert(all([c in ITEMS for b in baskets for c in b]))
-
-    # In the following, we use the i < j condition in the list comprehensions because all the metrics are symetrical and
-    # don't need to be calculated both ways.
-
-    # Local mutual information: Simple but not very smart.
-    lmi = {(i, j): local_mutual_information(i, j, baskets) for i in ITEMS for j in ITEMS if i < j}
-    list(reversed(sorted([(i, j, v) for (i, j), v in lmi.items()], key=lambda x: x[2])))
+    # Baskets are never modified once assembled: freeze them (hashable, immutable and safe to share).
+    baskets = [frozenset(b) for b in baskets]
+
+    # Check that we didn't misspell any items (against a set: one hash lookup per item instead of a scan of the list)
+    known_items = frozenset(ITEMS)
+    assert(all(c in known_items for b in baskets for c in b))
+
+    # Index the baskets once, all the metrics below count co-occurrences on these bitmaps.
+    bitmaps = item_bitmaps(baskets)
+
+    # Calculate contingency tables for all pair of items. We only consider the pairs i < j because all the metrics are
+    # symetrical and don't need to be calculated both ways.
+    ct = contingency_tables(ITEMS, baskets, bitmaps)
+
+    # Then score all the pairs in a single pass, the 3 measures side by side, all from the same table.
+    lmi, gmi, ll = {}, {}, {}
+    for pair, table in ct.items():
+        # Local mutual information: Simple but not very smart.
+        lmi[pair] = table.local_mutual_information()
+        # Using the whole contingency table: smarter, but costly.
+        # generalized MI
+        gmi[pair] = table.mutual_information()
+        # log-likelihood
+        ll[pair] = table.log_likelihood()
+
+    sorted(((i, j, v) for (i, j), v in lmi.items()), key=itemgetter(2), reverse=True)
     # From the above list, we can see that:
     # - Tennis Ball predicts the purchase of Tennis Racket (and vice-versa), as well as car predicts the purchase of a screwdriver
-    # - If you buy softener, you're less likely to buy toothpaste (although it's weak).
+    # - If you buy softener, you're less likely to buy toothpaste.
     # - Milk and Toothpaste are frequent items, most of the time their purchase is not strongly associated with another product
-    # - Screwdrivers and Toothpaste are bought together pretty much as expected if people were to randomly put stuff in their basket, and are therefore not associated (close to 0).
-
-    # Using contingency table: smarter, but costly.
-
-    # Calculate contingency tables for all pair of items
-    ct = {(i,j): ContingencyTable(i, j, baskets) for i in ITEMS for j in ITEMS if i < j}
+    # - Milk and Screwdrivers are bought together pretty much as expected if people were to randomly put stuff in their basket, and are therefore not associated (close to 0).
 
-    # Then it's easy to calculate the other measures.
-    # generalized MI
-    gmi = {(i, j): ct[(i, j)].mutual_information() for i in ITEMS for j in ITEMS if i < j}
-    list(reversed(sorted([(i, j, v) for (i, j), v in gmi.items()], key=lambda x: x[2])))
+    sorted(((i, j, v) for (i, j), v in gmi.items()), key=itemgetter(2), reverse=True)
     # This shows:
     # - Detergent/softener, Tennis racket/ball and car/screwdriver are very associated
     # - Milk and screwdrivers really are not
@@ -214,7 +372,5 @@ if __name__ == '__main__':
     # In practice, one would use this to answer the question "given I see the purchase X,
     # what are the top 5 items I should recommend, and how good is the recommendation".
 
-    # log-likelihood
-    ll = {(i, j): ct[(i, j)].log_likelihood() for i in ITEMS for j in ITEMS if i < j}
-    list(reversed(sorted([(i, j, v) for (i, j), v in ll.items()], key=lambda x: x[2])))
+    sorted(((i, j, v) for (i, j), v in ll.items()), key=itemgetter(2), reverse=True)
     # This exhibits the same outcome as the generalized mutual information (which is good news).